@@ -1,91 +1,410 @@
-import itertools
-
-import networkx as nx
+import numba
+import numpy as np
 from PySide2 import QtGui, QtCore, QtWidgets
+from scipy import ndimage, sparse
+
+
+@numba.njit(cache=True)
+def _reconstruct(predecessors: np.ndarray, target: int) -> np.ndarray:
+    length = 1
+    node = target
+    while predecessors[node] >= 0:
+        node = predecessors[node]
+        length += 1
+    node_ids = np.empty(length, np.int64)
+    node = target
+    for index in range(length - 1, -1, -1):
+        node_ids[index] = node
+        node = predecessors[node]
+    return node_ids
+
+
+@numba.njit(cache=True)
+def _stitch(forward: np.ndarray, backward: np.ndarray, meet_forward: int, meet_backward: int) -> np.ndarray:
+    head = _reconstruct(forward, meet_forward)
+    length = 0
+    node = meet_backward
+    while node >= 0:
+        node = backward[node]
+        length += 1
+    node_ids = np.empty(len(head) + length, np.int64)
+    node_ids[:len(head)] = head
+    node = meet_backward
+    for index in range(len(head), len(node_ids)):
+        node_ids[index] = node
+        node = backward[node]
+    return node_ids
+
+
+@numba.njit(cache=True)
+def _sift_up(heap: np.ndarray, positions: np.ndarray, keys: np.ndarray, index: int):
+    node = heap[index]
+    while index > 0:
+        parent = (index - 1) // 2
+        if keys[heap[parent]] <= keys[node]:
+            break
+        heap[index] = heap[parent]
+        positions[heap[index]] = index
+        index = parent
+    heap[index] = node
+    positions[node] = index
+
+
+@numba.njit(cache=True)
+def _sift_down(heap: np.ndarray, positions: np.ndarray, keys: np.ndarray, index: int, size: int):
+    node = heap[index]
+    while 2 * index + 1 < size:
+        child = 2 * index + 1
+        if child + 1 < size and keys[heap[child + 1]] < keys[heap[child]]:
+            child += 1
+        if keys[heap[child]] >= keys[node]:
+            break
+        heap[index] = heap[child]
+        positions[heap[index]] = index
+        index = child
+    heap[index] = node
+    positions[node] = index
+
+
+@numba.njit(cache=True)
+def _potential(node: int, columns: int, source: int, target: int, scale: float) -> float:
+    """Average of the straight-line estimates towards target and from source, consistent for both searches."""
+    x, y = node % columns, node // columns
+    return 0.5 * scale * (np.hypot(x - target % columns, y - target // columns) -
+                          np.hypot(x - source % columns, y - source // columns))
+
+
+@numba.njit(cache=True)
+def _bidirectional_astar(indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray, columns: int,
+                         source: int, target: int, scale: float, potentials: np.ndarray, distances: np.ndarray,
+                         predecessors: np.ndarray, heaps: np.ndarray, positions: np.ndarray,
+                         touched: np.ndarray) -> np.ndarray:
+    """Returns the node ids of a shortest path from source to target, empty if there is none.
+
+    Both searches run Dijkstra on weights reduced by the averaged straight-line potential, so the usual
+    bidirectional stopping rule stays valid while the heuristic steers them towards each other.
+    The scratch arrays come in cleared (nan, inf, -1, -1) and only the entries touched are reset on return."""
+    sizes = np.ones(2, np.int64)
+    counts = np.ones(2, np.int64)
+    for side, start in enumerate((source, target)):
+        distances[side, start] = 0.0
+        potentials[start] = _potential(start, columns, source, target, scale)
+        heaps[side, 0] = start
+        positions[side, start] = 0
+        touched[side, 0] = start
+    best = 0.0 if source == target else np.inf
+    meet_forward, meet_backward = (source, -1) if source == target else (-1, -1)
+    while sizes[0] and sizes[1]:
+        top_forward, top_backward = distances[0, heaps[0, 0]], distances[1, heaps[1, 0]]
+        if top_forward + top_backward >= best:
+            break
+        side = 0 if top_forward <= top_backward else 1
+        node = heaps[side, 0]
+        positions[side, node] = -1
+        sizes[side] -= 1
+        if sizes[side]:
+            heaps[side, 0] = heaps[side, sizes[side]]
+            _sift_down(heaps[side], positions[side], distances[side], 0, sizes[side])
+        # the backward search relaxes edges in reverse, which flips the sign of the potential difference
+        sign = 1.0 if side == 0 else -1.0
+        for edge in range(indptr[node], indptr[node + 1]):
+            neighbour = indices[edge]
+            if np.isnan(potentials[neighbour]):
+                potentials[neighbour] = _potential(neighbour, columns, source, target, scale)
+            distance = distances[side, node] + weights[edge] + sign * (potentials[neighbour] - potentials[node])
+            if distance < distances[side, neighbour]:
+                if distances[side, neighbour] == np.inf:
+                    touched[side, counts[side]] = neighbour
+                    counts[side] += 1
+                distances[side, neighbour] = distance
+                predecessors[side, neighbour] = node
+                if positions[side, neighbour] < 0:
+                    heaps[side, sizes[side]] = neighbour
+                    positions[side, neighbour] = sizes[side]
+                    sizes[side] += 1
+                _sift_up(heaps[side], positions[side], distances[side], positions[side, neighbour])
+            if distance + distances[1 - side, neighbour] < best:
+                best = distance + distances[1 - side, neighbour]
+                meet_forward, meet_backward = (node, neighbour) if side == 0 else (neighbour, node)
+    if meet_forward < 0:
+        node_ids = np.empty(0, np.int64)
+    else:
+        node_ids = _stitch(predecessors[0], predecessors[1], meet_forward, meet_backward)
+    for side in range(2):
+        for index in range(counts[side]):
+            node = touched[side, index]
+            potentials[node] = np.nan
+            distances[side, node] = np.inf
+            predecessors[side, node] = -1
+            positions[side, node] = -1
+    return node_ids
+
+
+@numba.njit(cache=True)
+def _path_edges(indptr: np.ndarray, indices: np.ndarray, node_ids: np.ndarray) -> np.ndarray:
+    edges = np.empty(max(len(node_ids) - 1, 0), np.int64)
+    for hop in range(len(edges)):
+        start = indptr[node_ids[hop]]
+        edges[hop] = start + np.searchsorted(indices[start:indptr[node_ids[hop] + 1]], node_ids[hop + 1])
+    return edges
+
+
+@numba.njit(cache=True)
+def _walk(factors: np.ndarray, weights: np.ndarray, terrains: np.ndarray, stage_terrain: int,
+          step_length: float, rest: float) -> tuple[np.ndarray, np.ndarray, float]:
+    """Rows of the returned arrays are (hop, distance, cost, terrain); hop indexes the path node."""
+    hops = len(factors)
+    rests = np.empty((hops, 4))
+    stages = np.empty((hops, 4))
+    rest_count = 0
+    stage_count = 0
+    rest_distance = 0.0
+    rest_cost = 0.0
+    stage_distance = 0.0
+    stage_cost = 0.0
+    total_distance = 0.0
+    for hop in range(hops):
+        distance = step_length * factors[hop]
+        cost = distance * weights[hop] / factors[hop]
+        terrain = terrains[hop]
+        rest_distance += distance
+        rest_cost += cost
+        stage_distance += distance
+        stage_cost += cost
+        total_distance += distance
+        if rest and rest_cost >= rest:
+            rests[rest_count, 0] = hop + 1
+            rests[rest_count, 1] = rest_distance
+            rests[rest_count, 2] = rest_cost
+            rests[rest_count, 3] = terrain
+            rest_count += 1
+            rest_distance = 0.0
+            rest_cost = 0.0
+        if terrain != stage_terrain or hop == hops - 1:
+            stages[stage_count, 0] = hop
+            stages[stage_count, 1] = stage_distance
+            stages[stage_count, 2] = stage_cost
+            stages[stage_count, 3] = stage_terrain
+            stage_count += 1
+            stage_terrain = terrain
+            stage_distance = 0.0
+    return rests[:rest_count], stages[:stage_count], total_distance
+
+
+@numba.njit(parallel=True, cache=True)
+def _build_edges(code_grid: np.ndarray, costs: np.ndarray, factors: np.ndarray,
+                 indptr: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Fills the CSR rows of the 8-neighbour grid graph, one image row per thread."""
+    rows, columns = code_grid.shape
+    indices = np.empty(indptr[-1], np.int32)
+    weights = np.empty(indptr[-1], np.int16)
+    factor_indices = np.empty(indptr[-1], np.uint8)
+    terrains = np.empty(indptr[-1], np.int8)
+    for j in numba.prange(rows):
+        for i in range(columns):
+            edge = indptr[j * columns + i]
+            # neighbours in row-major order keep every CSR row sorted by column
+            for dy in range(-1, 2):
+                for dx in range(-1, 2):
+                    if (dx == 0 and dy == 0) or not (0 <= j + dy < rows and 0 <= i + dx < columns):
+                        continue
+                    # the terrain of ties is taken from the left (or upper) end of the edge
+                    if dx > 0 or (dx == 0 and dy > 0):
+                        first, second = code_grid[j, i], code_grid[j + dy, i + dx]
+                    else:
+                        first, second = code_grid[j + dy, i + dx], code_grid[j, i]
+                    factor_index = 1 if dx and dy else 0
+                    indices[edge] = (j + dy) * columns + i + dx
+                    weights[edge] = int(min(costs[first], costs[second]) * factors[factor_index])
+                    factor_indices[edge] = factor_index
+                    terrains[edge] = first if costs[first] <= costs[second] else second
+                    edge += 1
+    return indices, weights, factor_indices, terrains
 
 
 class TopImage:
 
+    EDGE_FACTORS = (1.0, 1.5)
+    WINDOW_MARGIN = 16
+    WINDOW_PADDING = 0.2
+    WINDOW_SHARE = 0.25
+
     def __init__(self, image: QtGui.QImage):
-        self._density_dict: dict[tuple[int, int, int, int], tuple[str, int]] = {}
-        self._graph = nx.Graph()
+        self._code_grid = np.empty((0, 0), np.int8)
+        self._csr = sparse.csr_matrix((0, 0), dtype=np.int16)
+        self._colors_cache: tuple[tuple[int, int, int, int], ...] = ()
+        self._density_dict: dict[int, tuple[str, int]] = {}
+        self._density_source: dict[tuple[int, int, int, int], tuple[str, int]] | None = None
+        self._edge_factor_index = np.empty(0, np.uint8)
+        self._edge_terrain = np.empty(0, np.int8)
+        self._heuristic_scale = 0.0
+        self._search_buffers: tuple[np.ndarray, ...] = ()
+        self._snap = np.empty((0, 0), np.int32)
         self._image = image
+        self._keys = np.empty((0, 0), np.uint32)
         self._step_size = None
+        self._terrain_costs = np.zeros(1, np.int32)
+        self._terrain_index = np.zeros(1, np.int8)
+        self._terrains: tuple[str, ...] = ()
+        self._window: tuple[int, int, int, int] | None = None
 
     @property
     def colors(self) -> tuple[tuple[int, int, int, int]]:
-        return tuple(self._density_dict.keys())
+        return self._colors_cache
 
     @property
     def image(self) -> QtGui.QImage:
         return self._image
 
     def read_edges(self, density_dict: dict[tuple[int, int, int, int], tuple[str, int]]):
-        self._graph.clear_edges()
-        self._density_dict = density_dict.copy()
-
-        def get_density(s: tuple[int, int], t: tuple[int, int]) -> tuple[str, int]:
-            return min(density_dict[self._graph.nodes[s]['color']], density_dict[self._graph.nodes[t]['color']],
-                       key=lambda d: d[1])
-
-        def get_star(s: tuple[int, int]) -> iter:
-            return ((s, target, {'factor': factor, 'terrain': (d := get_density(s, target))[0],
-                                 'weight': int(d[1] * factor)})
-                    for (target, factor) in (
-                ((s[0] + self._step_size, s[1]), 1),
-                ((s[0], s[1] + self._step_size), 1),
-                ((s[0] + self._step_size, s[1] + self._step_size), 1.5),
-                ((s[0] + self._step_size, s[1] - self._step_size), 1.5),
-            ))
-
-        self._graph.add_edges_from(
-            itertools.chain(*(get_star((i, j))
-                              for i in range(self._step_size, self._image.width() - self._step_size - 1,
-                                             self._step_size)
-                              for j in range(self._step_size, self._image.height() - self._step_size - 1,
-                                             self._step_size)))
-        )
+        if density_dict is not self._density_source:
+            self._density_source = density_dict
+            self._colors_cache = tuple(density_dict)
+            self._density_dict = {int.from_bytes(bytes(color), 'little'): density
+                                  for color, density in density_dict.items()}
+        if len(self._density_dict) > np.iinfo(np.int8).max:
+            raise ValueError(f'density dicts are limited to {np.iinfo(np.int8).max} colors')
+        # code 0 stands for colors missing from the density dict, the others index it in order
+        palette_keys = np.array(list(self._density_dict), np.uint32)
+        palette_order = np.argsort(palette_keys)
+        sorted_keys = palette_keys[palette_order]
+        codes = np.minimum(np.searchsorted(sorted_keys, self._keys), len(sorted_keys) - 1)
+        self._code_grid = np.where(sorted_keys[codes] == self._keys, palette_order[codes] + 1, 0).astype(np.int8)
+        # colors sharing a terrain name map to one index, so stages only split where the name changes
+        names = ('', *(name for name, _ in self._density_dict.values()))
+        self._terrains = tuple(dict.fromkeys(names))
+        self._terrain_index = np.array([self._terrains.index(name) for name in names], np.int8)
+        self._terrain_costs = np.array([0, *(cost for _, cost in self._density_dict.values())], np.int32)
+        if self._terrain_costs.max() * max(self.EDGE_FACTORS) > np.iinfo(np.int16).max:
+            raise ValueError(f'terrain costs must stay below {np.iinfo(np.int16).max / max(self.EDGE_FACTORS):.0f}')
+        # lowest weight per unit of straight-line length keeps the A* heuristic admissible
+        present = np.bincount(self._code_grid.ravel(), minlength=len(self._terrain_costs)) > 0
+        lowest = self._terrain_costs[present].min() if present.any() else 0
+        self._heuristic_scale = min(int(lowest * factor) / length
+                                    for factor, length in zip(self.EDGE_FACTORS, (1.0, np.sqrt(2))))
+        # the graph itself is built by read_path, only for the part of the map a query needs
+        self._window = None
+
+        # every pixel points at the id of the closest node on known terrain, or the closest node at all
+        known = self._code_grid != 0
+        valid = np.zeros((self._image.height(), self._image.width()), bool)
+        valid[0:self._image.height() - 1:self._step_size, 0:self._image.width() - 1:self._step_size] = \
+            known if known.any() else True
+        rows, columns = ndimage.distance_transform_edt(~valid, return_distances=False, return_indices=True)
+        self._snap = (rows // self._step_size * self._code_grid.shape[1] + columns // self._step_size).astype(np.int32)
+
+    def _read_window(self, window: tuple[int, int, int, int]):
+        top, bottom, left, right = window
+        code_grid = np.ascontiguousarray(self._code_grid[top:bottom, left:right])
+        rows, columns = code_grid.shape
+        # every node links to its 8 neighbours, fewer along the border
+        row_counts = np.minimum(np.arange(rows) + 1, rows - 1) - np.maximum(np.arange(rows) - 1, 0) + 1
+        column_counts = np.minimum(np.arange(columns) + 1, columns - 1) - np.maximum(np.arange(columns) - 1, 0) + 1
+        indptr = np.concatenate(([0], np.cumsum(np.outer(row_counts, column_counts) - 1)))
+        indices, weights, self._edge_factor_index, self._edge_terrain = _build_edges(
+            code_grid, self._terrain_costs, np.array(self.EDGE_FACTORS), indptr)
+        self._csr = sparse.csr_matrix((weights, indices, indptr), shape=(rows * columns, rows * columns))
+        # potentials, distances, predecessors, heaps, positions and touched nodes, reused by every search
+        self._search_buffers = (np.full(rows * columns, np.nan), np.full((2, rows * columns), np.inf),
+                                np.full((2, rows * columns), -1, np.int32), np.empty((2, rows * columns), np.int32),
+                                np.full((2, rows * columns), -1, np.int32), np.empty((2, rows * columns), np.int32))
+        self._window = window
+
+    def _cell(self, node: tuple[int, int]) -> tuple[int, int]:
+        return node[1] // self._step_size, node[0] // self._step_size
+
+    def _contains(self, window: tuple[int, int, int, int]) -> bool:
+        return self._window is not None and self._window[0] <= window[0] and window[1] <= self._window[1] and \
+            self._window[2] <= window[2] and window[3] <= self._window[3]
+
+    def _exit_bound(self, source: tuple[int, int], target: tuple[int, int]) -> float:
+        """Lower bound on the weight of any route between two cells that leaves the current window."""
+        top, bottom, left, right = self._window
+        rows, columns = self._code_grid.shape
+        # shortest detour through a row or column just outside the window, by reflecting the target across it
+        detours = [np.inf]
+        if top > 0:
+            detours.append(np.hypot(source[1] - target[1], source[0] + target[0] - 2 * (top - 1)))
+        if bottom < rows:
+            detours.append(np.hypot(source[1] - target[1], 2 * bottom - source[0] - target[0]))
+        if left > 0:
+            detours.append(np.hypot(source[0] - target[0], source[1] + target[1] - 2 * (left - 1)))
+        if right < columns:
+            detours.append(np.hypot(source[0] - target[0], 2 * right - source[1] - target[1]))
+        return self._heuristic_scale * min(detours)
+
+    def _node_id(self, cell: tuple[int, int]) -> int:
+        return (cell[0] - self._window[0]) * (self._window[3] - self._window[2]) + cell[1] - self._window[2]
+
+    def _nodes(self, node_ids: np.ndarray) -> list[tuple[int, int]]:
+        j, i = np.divmod(node_ids, self._window[3] - self._window[2])
+        return list(zip(((i + self._window[2]) * self._step_size).tolist(),
+                        ((j + self._window[0]) * self._step_size).tolist()))
 
     def read_nodes(self, step_size: int = 1):
-        self._graph.clear()
         self._step_size = step_size
-        for i in range(0, self._image.width() - 1, step_size):
-            for j in range(0, self._image.height() - 1, step_size):
-                color = self._image.pixelColor(i, j).toTuple()
-                if color not in self._density_dict:
-                    self._density_dict[color] = ('', 0)
-                self._graph.add_node((i, j), color=color)
+        image = self._image.convertToFormat(QtGui.QImage.Format_RGBA8888)
+        width, height = image.width(), image.height()
+        pixels = np.frombuffer(image.constBits(), np.uint8, count=image.sizeInBytes()).reshape(
+            height, image.bytesPerLine())[:, :width * 4].reshape(height, width, 4)
+        pixels = np.ascontiguousarray(pixels[0:height - 1:step_size, 0:width - 1:step_size])
+        self._keys = pixels.view('<u4')[..., 0]
 
     def read_path(self, source: tuple[int, int], target: tuple[int, int], pixel_length: float = 1.0,
-                  rest: float = 0.0) -> dict[str, list[tuple[tuple[int, int], float, float, str]] | list[tuple[int, int]]]:
-        node_list = nx.single_source_dijkstra(self._graph, source, target)[1]
-        last_node = node_list[0]
-        rests = []
-        stages = []
-        rest_distance = 0.0
-        rest_cost = 0.0
-        stage_distance = 0.0
-        stage_cost = 0.0
-        stage_terrain = self._density_dict[self._graph.nodes[last_node]['color']][0]
-        for node in node_list[1:]:
-            edge = self._graph.edges[(last_node, node)]
-            distance = pixel_length * edge['factor'] * self._step_size
-            cost = distance * edge['weight'] / edge['factor']
-            terrain = edge['terrain']
-            rest_distance += distance
-            rest_cost += cost
-            stage_distance += distance
-            stage_cost += cost
-            if rest and rest_cost >= rest:
-                rests.append((node, rest_distance, rest_cost, terrain))
-                rest_distance = 0.0
-                rest_cost = 0.0
-            if terrain != stage_terrain or node == node_list[-1]:
-                stages.append((last_node, stage_distance, stage_cost, stage_terrain))
-                stage_terrain = terrain
-                stage_distance = 0.0
-            last_node = node
-        return {'rests': rests, 'stages': stages, 'nodes': node_list}
+                  rest: float = 0.0) -> dict[str, list[tuple[tuple[int, int], float, float, str]] |
+                                                   list[tuple[int, int]] | float]:
+        source_cell, target_cell = self._cell(source), self._cell(target)
+        rows, columns = self._code_grid.shape
+        top, bottom = sorted((source_cell[0], target_cell[0]))
+        left, right = sorted((source_cell[1], target_cell[1]))
+
+        def padded(padding: int) -> tuple[int, int, int, int]:
+            return (max(top - padding, 0), min(bottom + padding + 1, rows),
+                    max(left - padding, 0), min(right + padding + 1, columns))
+
+        # bounding box of both ends, padded so the route can bend around obstacles
+        padding = max(int(self.WINDOW_PADDING * max(bottom - top, right - left)), self.WINDOW_MARGIN)
+
+        def read_padded():
+            window = padded(padding)
+            # a window covering much of the map rarely proves its route, so search the whole map right away
+            if (window[1] - window[0]) * (window[3] - window[2]) > self.WINDOW_SHARE * rows * columns:
+                window = 0, rows, 0, columns
+            self._read_window(window)
+
+        if not self._contains(padded(0)):
+            read_padded()
+        while True:
+            node_ids = _bidirectional_astar(self._csr.indptr, self._csr.indices, self._csr.data,
+                                            self._window[3] - self._window[2], self._node_id(source_cell),
+                                            self._node_id(target_cell), self._heuristic_scale, *self._search_buffers)
+            edges = _path_edges(self._csr.indptr, self._csr.indices, node_ids)
+            # done once no route around the window could be cheaper, otherwise retry on a larger one
+            if self._window == (0, rows, 0, columns) or \
+                    len(node_ids) and self._csr.data[edges].sum() <= self._exit_bound(source_cell, target_cell):
+                break
+            while self._contains(padded(padding)):
+                padding *= 2
+            read_padded()
+        if not len(node_ids):
+            raise ValueError(f'no path from {source} to {target}')
+        rests, stages, total_distance = _walk(np.take(self.EDGE_FACTORS, self._edge_factor_index[edges]),
+                                              self._csr.data[edges], self._terrain_index[self._edge_terrain[edges]],
+                                              self._terrain_index[self._code_grid[source_cell]],
+                                              pixel_length * self._step_size, rest)
+        node_list = self._nodes(node_ids)
+        return {'rests': [(node_list[int(hop)], distance, cost, self._terrains[int(terrain)])
+                          for hop, distance, cost, terrain in rests.tolist()],
+                'stages': [(node_list[int(hop)], distance, cost, self._terrains[int(terrain)])
+                           for hop, distance, cost, terrain in stages.tolist()],
+                'nodes': node_list,
+                'distance': total_distance}
+
+    def snap(self, position: tuple[int, int]) -> tuple[int, int]:
+        x = min(max(position[0], 0), self._snap.shape[1] - 1)
+        y = min(max(position[1], 0), self._snap.shape[0] - 1)
+        j, i = divmod(int(self._snap[y, x]), self._code_grid.shape[1])
+        return i * self._step_size, j * self._step_size
 
     @property
     def step_size(self) -> int:
@@ -128,7 +447,6 @@ class Main(QtWidgets.QMainWindow):
         super().__init__()
         self.setWindowIcon(QtGui.QIcon('signal_flag_filled.png'))
         self.setWindowTitle('Pixelmap Cormyr')
-        self.current_pixmap = QtGui.QPixmap(self.size())
         self.setStyleSheet('*{font-family: Roboto Slab; font-size: 10pt}')
         self.setWindowFlag(QtCore.Qt.WindowMaximizeButtonHint, False)
         self.setWindowFlag(QtCore.Qt.WindowMinimizeButtonHint, False)
@@ -136,6 +454,13 @@ class Main(QtWidgets.QMainWindow):
         self.frame = QtWidgets.QFrame()
         self.setCentralWidget(self.frame)
         self.cormyr = Cormyr(self)
+        self.current_pixmap = self.cormyr.original_pixmap.copy()
+        self.dirty_rects: list[QtCore.QRect] = []
+        self.start_flag = QtGui.QImage('signal_flag_filled.png').scaled(20, 20, QtGui.Qt.KeepAspectRatio)
+        self.end_flag = QtGui.QImage('signal_flag_checkered_filled.png').scaled(20, 20, QtGui.Qt.KeepAspectRatio)
+        self.tent = QtGui.QImage('tent_filled.png').scaled(20, 20, QtGui.Qt.KeepAspectRatio)
+        self.start_icon = QtGui.QIcon('signal_flag.png')
+        self.end_icon = QtGui.QIcon('signal_flag_checkered.png')
 
         input_layout = QtWidgets.QGridLayout()
         self.start_position_box = QtWidgets.QComboBox()
@@ -177,11 +502,9 @@ class Main(QtWidgets.QMainWindow):
         self.terrain_budget.setCurrentText('24')
 
         self.start_position_box.currentIndexChanged.connect(
-            lambda _: self.start_position_label.setText(str(p)) if
-            (p := self.start_position_box.currentData(QtCore.Qt.UserRole)) else self.start_position_label.setText(''))
+            lambda _: self.set_position(self.start_position_label, self.start_position_box.currentData(QtCore.Qt.UserRole)))
         self.end_position_box.currentIndexChanged.connect(
-            lambda _: self.end_position_label.setText(str(p)) if
-            (p := self.end_position_box.currentData(QtCore.Qt.UserRole)) else self.end_position_label.setText(''))
+            lambda _: self.set_position(self.end_position_label, self.end_position_box.currentData(QtCore.Qt.UserRole)))
         self.start_position_box.currentIndexChanged.connect(lambda _: self.recalculate_states())
         self.end_position_box.currentIndexChanged.connect(lambda _: self.recalculate_states())
         self.recalculate_states()
@@ -189,10 +512,9 @@ class Main(QtWidgets.QMainWindow):
         self.cormyr.installEventFilter(self)
 
     def calculate(self):
-        try:
-            start_pos = eval(self.start_position_label.text())
-            end_pos = eval(self.end_position_label.text())
-        except SyntaxError:
+        start_pos = self.get_position(self.start_position_label)
+        end_pos = self.get_position(self.end_position_label)
+        if not (start_pos and end_pos):
             return
 
         budget = self.terrain_budget.currentData(QtCore.Qt.UserRole)
@@ -205,7 +527,7 @@ class Main(QtWidgets.QMainWindow):
         text = f'''<b>Start:</b>\t\t {start_pos}<br >
         <b>Destination:</b>\t\t {end_pos}<br >
         <b>Terrain Budget per Day:</b>\t\t {budget}<br >
-        <b>Total Distance:</b> {sum(stage[1] for stage in data['stages']):.2f} miles <br >
+        <b>Total Distance:</b> {data['distance']:.2f} miles <br >
         <b>Arrival:</b> on Day {len(data["rests"]) + 1}
         <br ><br >
         <b>Stages:</b><br >
@@ -215,16 +537,17 @@ class Main(QtWidgets.QMainWindow):
         {rest_text}
         '''
         self.result_edit.setHtml(text)
-        self.current_pixmap = self.cormyr.original_pixmap.copy()
-        painter = QtGui.QPainter(self.current_pixmap)
+        painter = self.restore_pixmap()
         pen = QtGui.QPen(QtGui.Qt.red, 3, QtGui.Qt.SolidLine, QtGui.Qt.RoundCap, QtGui.Qt.RoundJoin)
         painter.setPen(pen)
         painter.setRenderHint(painter.Antialiasing, True)
-        for last_node, node in itertools.pairwise(data['nodes']):
-            painter.drawLine(*last_node, *node)
-        tent = QtGui.QImage('tent_filled.png').scaled(20, 20, QtGui.Qt.KeepAspectRatio)
+        polyline = QtGui.QPolygonF([QtCore.QPointF(x, y) for x, y in data['nodes']])
+        painter.drawPolyline(polyline)
+        self.dirty_rects = [polyline.boundingRect().toAlignedRect().adjusted(-3, -3, 3, 3)]
         for (x, y), *_ in data['rests']:
-            painter.drawImage(x - 10, y - 10, tent)
+            painter.drawImage(x - 10, y - 10, self.tent)
+            self.dirty_rects.append(QtCore.QRect(x - 10, y - 10, 20, 20))
+        painter.end()
         self.cormyr.setPixmap(self.current_pixmap)
 
     def eventFilter(self, watched: QtWidgets.QWidget, event: QtCore.QEvent) -> bool:
@@ -236,42 +559,55 @@ class Main(QtWidgets.QMainWindow):
 
     def map_menu(self, event: QtCore.QEvent.ContextMenu):
         menu = QtWidgets.QMenu(self)
-        position = str(tuple(map(lambda c: c - c % self.cormyr.image.step_size, event.pos().toTuple())))
-        start_action = QtWidgets.QAction(QtGui.QIcon('signal_flag.png'), 'Start Here', self)
+        position = self.cormyr.image.snap(event.pos().toTuple())
+        start_action = QtWidgets.QAction(self.start_icon, 'Start Here', self)
         start_action.triggered.connect(lambda:
                                        (self.start_position_box.setCurrentText('custom'),
-                                        self.start_position_label.setText(position),
+                                        self.set_position(self.start_position_label, position),
                                         self.recalculate_states()))
-        end_action = QtWidgets.QAction(QtGui.QIcon('signal_flag_checkered.png'), 'Destination Here', self)
+        end_action = QtWidgets.QAction(self.end_icon, 'Destination Here', self)
         end_action.triggered.connect(lambda:
                                      (self.end_position_box.setCurrentText('custom'),
-                                      self.end_position_label.setText(position),
+                                      self.set_position(self.end_position_label, position),
                                       self.recalculate_states()))
         menu.addActions([start_action, end_action])
         menu.popup(event.globalPos())
 
+    @staticmethod
+    def get_position(label: QtWidgets.QLabel) -> tuple[int, int] | None:
+        return tuple(position) if (position := label.property('position')) else None
+
     def recalculate_states(self):
-        try:
-            start_pos = eval(self.start_position_label.text())
-        except SyntaxError:
-            start_pos = None
-        try:
-            end_pos = eval(self.end_position_label.text())
-        except SyntaxError:
-            end_pos = None
+        start_pos = self.get_position(self.start_position_label)
+        end_pos = self.get_position(self.end_position_label)
         enabled = bool(start_pos and end_pos and start_pos != end_pos)
-        self.current_pixmap = self.cormyr.original_pixmap.copy()
-        painter = QtGui.QPainter(self.current_pixmap)
-        if start_pos:
-            flag = QtGui.QImage('signal_flag_filled.png').scaled(20, 20, QtGui.Qt.KeepAspectRatio)
-            painter.drawImage(start_pos[0] - 10, start_pos[1] - 10, flag)
-        if end_pos:
-            flag = QtGui.QImage('signal_flag_checkered_filled.png').scaled(20, 20, QtGui.Qt.KeepAspectRatio)
-            painter.drawImage(end_pos[0] - 10, end_pos[1] - 10, flag)
+        painter = self.restore_pixmap()
+        self.dirty_rects = []
+        for pos, flag in ((start_pos, self.start_flag), (end_pos, self.end_flag)):
+            if pos:
+                painter.drawImage(pos[0] - 10, pos[1] - 10, flag)
+                self.dirty_rects.append(QtCore.QRect(pos[0] - 10, pos[1] - 10, 20, 20))
+        painter.end()
 
         self.calculate_button.setEnabled(enabled)
         self.cormyr.setPixmap(self.current_pixmap)
 
+    @staticmethod
+    def set_position(label: QtWidgets.QLabel, position: tuple[int, int] | None):
+        # 'pos' is taken by QWidget's own geometry property
+        label.setProperty('position', position)
+        label.setText(str(position) if position else '')
+
+    def restore_pixmap(self) -> QtGui.QPainter:
+        # the label shares the pixmap, release it so painting does not detach a full copy
+        self.cormyr.clear()
+        painter = QtGui.QPainter(self.current_pixmap)
+        painter.setCompositionMode(painter.CompositionMode_Source)
+        for rect in self.dirty_rects:
+            painter.drawPixmap(rect, self.cormyr.original_pixmap, rect)
+        painter.setCompositionMode(painter.CompositionMode_SourceOver)
+        return painter
+
 
 app = QtWidgets.QApplication()
 main = Main()